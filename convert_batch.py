@@ -1,41 +1,56 @@
 import argparse
+import atexit
 import contextlib
 import datetime
 import glob
+import hashlib
 import json
 import math
+import multiprocessing
 import os
+import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import yaml
 
-from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import Manager, Queue
-from threading import Thread
-from time import sleep
-from typing import Dict, Optional
-from urllib.parse import urlparse, quote, unquote
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count, islice
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs, unquote
 
+import fitz as pymupdf
+import torch
+
+from azure.core.exceptions import AzureError
 from azure.keyvault.secrets import SecretClient
 from azure.identity import DefaultAzureCredential, AzureCliCredential
+from azure.storage.blob import BlobClient, ContainerClient, ContentSettings, ExponentialRetry
 
 from loguru import logger
+from tenacity import retry, stop_after_attempt, wait_exponential
 
-from marker.convert import convert_single_pdf, get_length_of_text
+from marker.convert import convert_single_pdf, find_filetype, get_length_of_pages
 from marker.models import load_all_models
-from marker.settings import settings
+from marker.settings import settings, PRECISION_DTYPES
 from marker.logger import configure_logging
 
 from obsidian.core.azure.batch import utils as batch_utils
-from obsidian.core.data import azcopy
 from obsidian.core.utils import gen_obsidian_init_command, gen_pip_command, gen_apt_command
 
 g_config = None
 g_sas_token = None
+g_models = None
+g_dst_container = None
+g_scratch_dir = None
+g_group_ids = count() # Bump allocator for the group folders under the scratch dir
 
 configure_logging()
-logger.add("pdfmarker.log", rotation="10 MB", retention="10 days", level="INFO")
+g_log_handler = logger.add("pdfmarker.log", rotation="10 MB", retention="10 days", level="INFO")
 
 @contextlib.contextmanager
 def timer(name):
@@ -53,6 +68,25 @@ class QuickDict(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+class RateLimiter:
+    """Token bucket shared by the threads of a process, allowing `rate` calls per second in bursts of up to `rate`."""
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going below zero reserves the next token, so concurrent callers queue up in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
 def get_config(config_file) -> QuickDict:
     if os.path.exists(config_file):
         with open(config_file, "r", encoding="utf-8") as f_conf:
@@ -62,6 +96,24 @@ def get_config(config_file) -> QuickDict:
     
     return config_data
 
+TRANSFER_GROUP_SIZE = 16 # Files per azcopy job, the unit of the download/convert/upload pipeline
+PREFETCH_GROUPS = 2 # How many groups to download ahead of the one being converted
+TEXT_SAMPLE_PAGES = 3 # Pages read to decide the min_length filter before paying for a full text pass
+MAX_GPU_WORKERS = 3 # Conversions sharing one GPU at a time, more only thrash its memory
+INDEX_CACHE_DIR = os.environ.get("AZ_BATCH_NODE_SHARED_DIR", "/var/tmp") # Shared by every task on the node
+AZCOPY_RATE = 5 # azcopy jobs started per second, to stay clear of storage throttling
+BLOB_CONCURRENCY = 8 # Parallel blob requests per group, they share the container client's connection pool
+SAS_CACHE_MIN_TTL = datetime.timedelta(hours=1) # A cached sas token is reused only if it stays valid this long
+
+# azcopy tuning for many small-to-medium files, the environment wins if it sets these already
+AZCOPY_ENV = {
+    "AZCOPY_CONCURRENCY_VALUE": "AUTO",
+    "AZCOPY_BUFFER_GB": "4",
+    "AZCOPY_CONCURRENT_SCAN": "64",
+    "AZCOPY_PARALLEL_STAT_FILES": "true",
+}
+AZCOPY_FLAGS = ["--log-level=ERROR", "--check-length=false"]
+
 ENV_OFFSET = 'MY_JOB_OFFSET'
 ENV_LENGTH = 'MY_JOB_LENGTH'
 ENV_INDEX_URL = 'MY_INDEX_URL'
@@ -83,7 +135,87 @@ def get_config_fromenv():
         "length": int(os.environ[ENV_LENGTH]),
     })
 
-def get_blob_sas(identity_id: str, keyvault_name: str, secret_name: str):
+def get_credential(url: str):
+    """The sas token of a storage url if it carries one, the node's managed identity otherwise."""
+    return urlparse(url).query or DefaultAzureCredential(
+        exclude_shared_token_cache_credential=True,
+        managed_identity_client_id=g_config.identity_id
+    )
+
+def get_container_client(url: str) -> Tuple[ContainerClient, str]:
+    """Build a client for a container url, returning it with the blob name prefix of its virtual folder, if any."""
+    # url: https://abc.blob.core.windows.net/yyy[/prefix]?<sas_token>
+    parsed = urlparse(url)
+    container_name, _, prefix = unquote(parsed.path).lstrip("/").partition("/")
+    client = ContainerClient(
+        f"{parsed.scheme}://{parsed.netloc}",
+        container_name,
+        credential=get_credential(url),
+        retry_policy=ExponentialRetry(initial_backoff=2, increment_base=2, retry_total=3)
+    )
+    prefix = prefix.strip("/")
+    return client, f"{prefix}/" if prefix else ""
+
+def get_dst_container() -> Tuple[ContainerClient, str]:
+    """One container client per process, so every upload reuses its connection pool."""
+    global g_dst_container
+    if g_dst_container is None:
+        g_dst_container = get_container_client(g_config.dst_url)
+    return g_dst_container
+
+def get_dst_blob_name(relative_path: str) -> str:
+    # relative_path: A/B/[10.1002]sample.md
+    _, prefix = get_dst_container()
+    return prefix + relative_path
+
+def get_sas_expiry(secret) -> Optional[datetime.datetime]:
+    # The signed expiry of the token itself (se=) is the real limit, the secret's expiry is only a fallback
+    signed_expiry = parse_qs(secret.value.lstrip("?")).get("se")
+    expires_on = datetime.datetime.fromisoformat(signed_expiry[0].replace("Z", "+00:00")) if signed_expiry else secret.properties.expires_on
+    if expires_on is not None and expires_on.tzinfo is None:
+        expires_on = expires_on.replace(tzinfo=datetime.timezone.utc)
+    return expires_on
+
+def read_cached_sas(cache_file: str) -> Optional[str]:
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            # The temp dir is shared, only trust a file this user wrote and nobody else can read
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.getuid() or st.st_mode & 0o777 != 0o600:
+                return None
+            cached = json.load(f)
+        expires_on = datetime.datetime.fromisoformat(cached["expires_on"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if expires_on - datetime.datetime.now(datetime.timezone.utc) > SAS_CACHE_MIN_TTL:
+        return cached["value"]
+    return None
+
+def write_cached_sas(cache_file: str, value: str, expires_on: datetime.datetime):
+    # mkstemp creates a fresh file readable by the owner only, moved into place so a concurrent reader never sees half a file
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"value": value, "expires_on": expires_on.isoformat()}, f)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        remove_files(tmp_file)
+        raise
+
+def with_suffix(path: str, suffix: str) -> str:
+    # String-only os.path.splitext(path)[0] + suffix for the posix paths of this script
+    dot = path.rfind(".")
+    return (path[:dot] if dot > path.rfind("/") + 1 else path) + suffix
+
+def get_blob_sas(identity_id: str, keyvault_name: str, secret_name: str, use_cache: bool = True) -> str:
+    """Get the sas token from Key Vault, reusing the copy cached by an earlier process while it is still valid."""
+    cache_file = os.path.join(tempfile.gettempdir(), f".sas-{keyvault_name}-{secret_name}.json")
+    sas_token = read_cached_sas(cache_file) if use_cache else None
+    if sas_token is not None:
+        logger.info("Using cached sas token")
+        return sas_token
+
     KVUri = f"https://{keyvault_name}.vault.azure.net/"
 
     credential = DefaultAzureCredential(
@@ -91,148 +223,404 @@ def get_blob_sas(identity_id: str, keyvault_name: str, secret_name: str):
         managed_identity_client_id=identity_id
     )
     client = SecretClient(vault_url=KVUri, credential=credential)
-
-    return client.get_secret(secret_name)
-
-def monitor_queue(queue):
-    while True:
-        sleep(0.1)  # Check the queue every 100ms
-        message = queue.get()
-        if message is None:  # Check for sentinel value
-            break
-        print(message)
+    secret = client.get_secret(secret_name)
+
+    expires_on = get_sas_expiry(secret)
+    if expires_on is not None:
+        try:
+            write_cached_sas(cache_file, secret.value, expires_on)
+        except OSError as e:
+            logger.warning(f"Could not cache sas token: {e}")
+    return secret.value
+
+def load_models():
+    """Load the models once per process, so every task the process handles reuses them."""
+    global g_models
+    with timer("load_models"):
+        g_models = load_all_models()
+
+def get_models():
+    if g_models is None:
+        load_models()
+    return g_models
+
+def init_worker(workers: int, precision: Optional[str] = None):
+    # Workers import the shared log file with this module, swap it for a per-process one to merge afterwards
+    logger.remove(g_log_handler)
+    logger.add(f"pdfmarker-{os.getpid()}.log", rotation="10 MB", retention="10 days", level="INFO")
+    # torch uses every core per process by default, split them between the workers instead
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    if precision is not None:
+        settings.MODEL_PRECISION = precision
+    load_models()
+
+def get_scratch_dir() -> str:
+    """One scratch folder per process, shared by every run instead of a new temporary directory each time."""
+    global g_scratch_dir
+    if g_scratch_dir is None:
+        g_scratch_dir = tempfile.mkdtemp(dir=os.getcwd())
+        # workers never ask for one, so only the process that made it removes it
+        atexit.register(shutil.rmtree, g_scratch_dir, ignore_errors=True)
+    return g_scratch_dir
 
 def get_file_count(url):
-    with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp_dir:
-        index_file = azcopy.copy(url, tmp_dir)
-        with open(index_file) as fin:
-            return sum(1 for _ in fin)
+    index_file = get_index_file(url)
+    with open(index_file) as fin:
+        return sum(1 for _ in fin)
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
-def pre_process(fname: str, out_folder: str):
-    # fname: A/B/[10.1002]sample.pdf
-    in_url = azcopy.join_path(g_config.src_url, fname) # https://abc.blob.core.windows.net/xxx/A/B/[10.1002]sample.pdf
-    return azcopy.copy(in_url, out_folder) # .../tmp2p_abcd/[10.1002]sample.pdf
-
-def post_process(full_text, out_filename, out_url):
-    basename = os.path.basename(out_filename)
+azcopy_limiter = RateLimiter(AZCOPY_RATE)
+azcopy_retry = retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=2, max=30), reraise=True)
+
+def run_azcopy(src: str, dst: str, *flags) -> subprocess.CompletedProcess:
+    cmd = ["azcopy", "copy", src, dst, *AZCOPY_FLAGS, *flags]
+    azcopy_limiter.acquire()
+    return subprocess.run(cmd, capture_output=True, text=True)
+
+@azcopy_retry
+def azcopy_download(url: str, out_folder: str) -> str:
+    """Download a single blob into out_folder, returning the local path."""
+    local_file = os.path.join(out_folder, unquote(os.path.basename(urlparse(url).path)))
+    result = run_azcopy(url, local_file)
+    if result.returncode != 0:
+        raise RuntimeError(f"azcopy failed to download {local_file}: {result.stdout[-2000:]}")
+    return local_file
+
+def get_index_file(url: str) -> str:
+    """Download the index once per node and version, every later task on the node reads the local copy."""
+    # Outside the cluster there is no node to share it with, keep it in the scratch dir that goes away on exit
+    cache_dir = INDEX_CACHE_DIR if batch_utils.in_batch_cluster() else get_scratch_dir()
+    # Key by the blob without its sas token, and by its etag so a replaced index is downloaded again
+    blob_url = urlparse(url)._replace(query="").geturl()
+    etag = BlobClient.from_blob_url(blob_url, credential=get_credential(url)).get_blob_properties().etag.strip('"')
+    url_key = hashlib.sha256(blob_url.encode()).hexdigest()[:16]
+    etag_key = hashlib.sha256(etag.encode()).hexdigest()[:16]
+    index_file = os.path.join(cache_dir, f"pdfmarker-index-{url_key}-{etag_key}.txt")
+    if os.path.exists(index_file):
+        logger.info(f"Using cached index {index_file}")
+        return index_file
+
+    # Download next to the cache and move it in, so concurrent tasks never read a partial index
+    download_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        os.replace(azcopy_download(url, download_dir), index_file)
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    # Older versions of the same index are never read again, tasks still reading one keep their open handle
+    stale_files = glob.glob(os.path.join(cache_dir, f"pdfmarker-index-{url_key}-*.txt"))
+    remove_files(*(stale_file for stale_file in stale_files if stale_file != index_file))
+    return index_file
+
+@azcopy_retry
+def azcopy_batch(src: str, dst: str, list_file: str):
+    """Run a single azcopy job over every path in list_file, so the process startup is paid once per batch."""
+    result = run_azcopy(src, dst, f"--list-of-files={list_file}", "--recursive", "--as-subdir=false")
+    if result.returncode != 0:
+        raise RuntimeError(f"azcopy exited with code {result.returncode}: {result.stdout[-2000:]}")
+
+def write_list_file(list_file: str, relative_paths: list):
+    with open(list_file, "w", encoding="utf-8") as f:
+        for path in relative_paths:
+            f.write(path + "\n")
+
+def is_converted(relative_path: str) -> bool:
+    # A single HEAD on the output blob, far cheaper than downloading and converting again on a rerun
+    container, _ = get_dst_container()
+    blob_name = get_dst_blob_name(with_suffix(relative_path, ".md"))
+    try:
+        return container.get_blob_client(blob_name).exists()
+    except AzureError as e:
+        # Converting it again is only wasted work, unlike failing the whole task
+        logger.warning(f"Could not check {blob_name}: {e}")
+        return False
+
+def pre_process(minibatch: list, out_folder: str, overwrite: bool = False) -> Dict[str, str]:
+    # minibatch: [A/B/[10.1002]sample.pdf, ...]
+    if not overwrite:
+        with ThreadPoolExecutor(max_workers=BLOB_CONCURRENCY) as pool:
+            converted = list(pool.map(is_converted, minibatch))
+        skipped = sum(converted)
+        if skipped:
+            logger.info(f"Skipping {skipped} already converted files")
+            minibatch = [fname for fname, done in zip(minibatch, converted) if not done]
+        if not minibatch:
+            return {}
+
+    os.makedirs(out_folder, exist_ok=True)
+    list_file = os.path.join(out_folder, "download.lst")
+    write_list_file(list_file, minibatch)
+
+    logger.info(f"Downloading {len(minibatch)} files")
+    with timer("pre_process"):
+        try:
+            azcopy_batch(g_config.src_url, out_folder, list_file)
+        except RuntimeError as e:
+            # azcopy also fails when only some of the files did, what arrived is checked below
+            logger.warning(str(e))
+
+    # azcopy keeps the relative layout: .../tmp2p_abcd/pdfs/A/B/[10.1002]sample.pdf
+    local_files = {fname: f"{out_folder}/{fname}" for fname in minibatch}
+    # A file still missing after the retries fails the task, so Batch runs it again instead of reporting success
+    missing = [local_file for local_file in local_files.values() if not os.path.exists(local_file)]
+    if missing:
+        raise RuntimeError(f"{len(missing)}/{len(minibatch)} files missing after download, first: {missing[0]}")
+    return local_files
+
+def save_markdown(full_text: str, out_filename: str) -> bool:
     if len(full_text.strip()) > 0:
         with open(out_filename, "w+", encoding='utf-8') as f:
             f.write(full_text)
-        
-        logger.info(f"Uploading {unquote(basename)}")
-        azcopy.upload(out_filename, out_url)
 
         # ignore the metadata for now
         # with open(out_meta_filename, "w+") as f:
         #     f.write(json.dumps(out_metadata, indent=4))
-    else:
-        logger.info(f"Empty file: {unquote(basename)}.  No valid convert result")
+        return True
 
-def process_single_pdf(
-    fname: str,
-    out_folder: str, 
-    models,
-    min_length: Optional[int] = None,
-    queue = None
-    ):
-    
-    # fname: A/B/[10.1002]sample.pdf
-    try:
-        local_file = pre_process(fname, out_folder) # .../tmp2p_abcd/[10.1002]sample.pdf        
+    logger.opt(lazy=True).info("Empty file: {}.  No valid convert result", lambda: os.path.basename(out_filename))
+    return False
 
-        local_file_noext = os.path.splitext(local_file)[0] # .../tmp2p_abcd/[10.1002]sample
-        out_filename = local_file_noext + ".md" # .../tmp2p_abcd/[10.1002]sample.md
-        # out_meta_filename = local_file_noext + "_meta.json" # .../tmp2p_abcd/[10.1002]sample_meta.json
+def remove_files(*paths):
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
 
-        out_relative_path = os.path.splitext(fname)[0] + ".md" # A/B/[10.1002]sample.md
-        out_url = azcopy.join_path(g_config.dst_url, out_relative_path) # https://abc.blob.core.windows.net/yyy/A/B/[10.1002]sample.md
+def upload_markdown(container: ContainerClient, blob_name: str, out_filename: str) -> bool:
+    try:
+        with open(out_filename, "rb") as data:
+            container.upload_blob(
+                blob_name,
+                data,
+                overwrite=True,
+                content_settings=ContentSettings(content_type="text/markdown; charset=utf-8")
+            )
+        return True
+    except Exception as e:
+        logger.info(f"Error uploading {blob_name}")
+        logger.exception(e)
+        return False
+    finally:
+        remove_files(out_filename)
+
+def post_process(out_files: list, out_folder: str):
+    # out_files: [.../tmp2p_abcd/pdfs/A/B/[10.1002]sample.md, ...]
+    uploaded = 0
+    if out_files:
+        container, _ = get_dst_container()
+        # out_files were built as out_folder/relative_path, so slicing recovers the relative path
+        blob_names = [get_dst_blob_name(out_file[len(out_folder) + 1:]) for out_file in out_files]
+
+        logger.info(f"Uploading {len(out_files)} files")
+        with timer("post_process"), ThreadPoolExecutor(max_workers=BLOB_CONCURRENCY) as pool:
+            uploaded = sum(pool.map(lambda args: upload_markdown(container, *args), zip(blob_names, out_files)))
+        logger.info(f"Uploaded {uploaded}/{len(out_files)} files")
+
+    # Every file of the group is done by now, sweep whatever the per-file cleanup left behind
+    # (list files, partial downloads) so scratch only holds the groups in flight
+    shutil.rmtree(out_folder, ignore_errors=True)
+
+    # The local markdown is gone either way, failing the task lets Batch convert and upload the group again
+    if uploaded < len(out_files):
+        raise RuntimeError(f"Failed to upload {len(out_files) - uploaded}/{len(out_files)} files")
+
+def is_long_enough(local_file: str, min_length: int) -> Tuple[bool, int]:
+    """Apply the min_length filter from the first pages, reading all the text only when they cannot decide."""
+    filetype = find_filetype(local_file)
+    if filetype == "other":
+        return False, 0
+
+    with pymupdf.open(local_file, filetype=filetype) as doc:
+        # Indexed rather than doc.pages(), which rejects a start page past the end of short documents
+        length = get_length_of_pages(doc[pnum] for pnum in range(min(TEXT_SAMPLE_PAGES, doc.page_count)))
+        if length >= min_length or doc.page_count <= TEXT_SAMPLE_PAGES:
+            return length >= min_length, length
+
+        # Clearly short documents are decided by the extrapolated estimate, a sample without
+        # any text (scanned or blank front matter) says nothing about the rest and gets the full pass
+        if length > 0:
+            estimate = length * doc.page_count // TEXT_SAMPLE_PAGES
+            if estimate < min_length // 2:
+                return False, estimate
+
+        length += get_length_of_pages(doc[pnum] for pnum in range(TEXT_SAMPLE_PAGES, doc.page_count))
+    return length >= min_length, length
+
+def get_parallel_factor(workers: int, device: str) -> int:
+    # Give each worker its share of the GPU as bigger model batches, on cpu the default batch sizes already fit
+    if device != "cuda":
+        return 1
+    return max(1, int(settings.INFERENCE_RAM / (workers * settings.VRAM_PER_TASK)))
+
+def convert_pdf(local_file: str, parallel_factor: int = 1) -> str:
+    # Runs in the conversion workers, which hold their own models
+    # parallel_factor is a share of VRAM, so it only grows the model batches, tesseract threads stay at the configured count
+    with timer("convert_pdf"), torch.inference_mode():
+        full_text, out_metadata = convert_single_pdf(
+            local_file, get_models(), parallel_factor=parallel_factor, ocr_parallel=settings.OCR_PARALLEL_WORKERS
+        )
+    return full_text
 
-        logger.info(f"Converting {unquote(fname)}")
+def process_single_pdf(
+    fname: str,
+    local_file: str,
+    executor,
+    min_length: Optional[int] = None,
+    parallel_factor: int = 1
+    ) -> Optional[Future]:
+    """Filter the pdf and submit it for conversion, returning the future of its text if it was submitted."""
 
+    # fname: A/B/[10.1002]sample.pdf, local_file: .../tmp2p_abcd/pdfs/A/B/[10.1002]sample.pdf
+    try:
         # Skip trying to convert files that don't have a lot of embedded text
         # This can indicate that they were scanned, and not OCRed properly
         # Usually these files are not recent/high-quality
         if min_length:
-            length = get_length_of_text(local_file)
-            if length < min_length:
-                logger.info(f"Skipping {unquote(local_file)}: length {length} < {min_length}")
-                return
+            long_enough, length = is_long_enough(local_file, min_length)
+            if not long_enough:
+                logger.info("Skipping {}: length {} < {}", fname, length, min_length)
+                return None
+
+        logger.info("Converting {}", fname)
+        # Whole documents, marker's ocr and header/footer heuristics depend on the document's page count and boundaries
+        return executor.submit(convert_pdf, local_file, parallel_factor)
+    except BrokenProcessPool:
+        # a dead pool fails every later file too, let it end the task instead of logging each one
+        raise
+    except Exception as e:
+        logger.info("Error converting {}", fname)
+        logger.exception(e)
+
+    return None
 
-        full_text, out_metadata = convert_single_pdf(local_file, models)
-        post_process(full_text, out_filename, out_url)
+def collect_single_pdf(fname: str, local_file: str, conversion: Optional[Future]) -> Optional[str]:
+    """Wait for the converted text and save it, returning the markdown file if any."""
+    out_filename = with_suffix(local_file, ".md") # .../tmp2p_abcd/pdfs/A/B/[10.1002]sample.md
+    # out_meta_filename = with_suffix(local_file, "_meta.json") # .../tmp2p_abcd/pdfs/A/B/[10.1002]sample_meta.json
+    try:
+        if conversion is not None:
+            if save_markdown(conversion.result(), out_filename):
+                return out_filename
+    except BrokenProcessPool:
+        raise
     except Exception as e:
-        logger.info(f"Error converting {unquote(local_file)}")
+        logger.info("Error converting {}", fname)
         logger.exception(e)
+    finally:
+        # The input is not needed anymore, whether the conversion worked or not
+        remove_files(local_file)
+
+    return None
 
 def process_minibatch(
     minibatch: list,
-    out_folder: str, 
+    out_folder: str,
+    executor,
     min_length: Optional[int] = None,
-    queue = None
+    overwrite: bool = False,
+    parallel_factor: int = 1
     ):
-    with timer("load_models"):
-        models = load_all_models()
-    
     logger.info(f"minibatch of {len(minibatch)} files")
     
-    with timer("process_minibatch"):
-        for fname in minibatch:
-            with timer("process_single_pdf"):
-                process_single_pdf(fname, out_folder, models, min_length, queue)
-
-def run(offset, length, min_length, workers):
-    with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp_dir:
-        logger.info(f"run(offset={offset}, length={length}, min_length={min_length}, workers={workers})")
-        logger.info(f'Using temp dir: {tmp_dir}')
-        
-        logger.info(f'Get file list from Azure storage...')
-
-        with timer("get_index"):
-            index_file = azcopy.copy(g_config.index_url, tmp_dir)
-            with open(index_file) as fin:
-                urls = [quote(url.strip()) for url in fin.readlines()][offset: offset + length]
-        
-        logger.info(f'Processing {len(urls)} files')
-
-        queue = None
-        
-        #file_batches = list(chunks(urls, max(length // (workers * 2), 1)))
-
-        # do it in a single process sequentially
-        #for minibatch in file_batches:
-        #    process_minibatch(minibatch, tmp_dir, min_length=min_length, queue=queue)
-        process_minibatch(urls, tmp_dir, min_length=min_length, queue=queue)
-
-        # do it in parallel with multiple processes
-        # with Manager() as manager:
-        #     queue = manager.Queue()
-        #     monitor_thread = Thread(target=monitor_queue, args=(queue, ))
-        #     monitor_thread.start()
-                
-        #     with ProcessPoolExecutor(max_workers=workers) as executor:
-        #         for mini_batch in file_batches:
-        #             executor.submit(process_minibatch, mini_batch, tmp_dir, min_length, queue)
-                
-        #         executor.shutdown(wait=True)
-            
-        #     queue.put(None)
-        #     monitor_thread.join()
+    # Split the minibatch into transfer groups, each staged in its own folder, so the next groups
+    # download and the previous ones upload while the current one is being converted
+    groups = [
+        (group, f"{out_folder}/{next(g_group_ids):06d}")
+        for group in chunks(minibatch, TRANSFER_GROUP_SIZE)
+    ]
+    pending = iter(groups)
+
+    with timer("process_minibatch"), \
+            ThreadPoolExecutor(max_workers=PREFETCH_GROUPS) as dl_pool, \
+            ThreadPoolExecutor(max_workers=PREFETCH_GROUPS) as ul_pool:
+        downloads = deque(
+            (group, group_dir, dl_pool.submit(pre_process, group, group_dir, overwrite))
+            for group, group_dir in islice(pending, PREFETCH_GROUPS)
+        )
+        uploads = []
+
+        def finish_group(group_dir, local_files, conversions):
+            out_files = []
+            for fname, conversion in conversions.items():
+                out_file = collect_single_pdf(fname, local_files[fname], conversion)
+                if out_file:
+                    out_files.append(out_file)
+            uploads.append(ul_pool.submit(post_process, out_files, group_dir))
+
+        # Files of the next group are submitted before the previous group is collected,
+        # so the conversion workers never wait on a group boundary
+        in_flight = None
+        while downloads:
+            group, group_dir, download = downloads.popleft()
+            for next_group, next_dir in islice(pending, 1):
+                downloads.append((next_group, next_dir, dl_pool.submit(pre_process, next_group, next_dir, overwrite)))
+
+            local_files = download.result()
+            conversions = {
+                fname: process_single_pdf(fname, local_file, executor, min_length, parallel_factor)
+                for fname, local_file in local_files.items()
+            }
+
+            if in_flight:
+                finish_group(*in_flight)
+            in_flight = (group_dir, local_files, conversions)
+
+        if in_flight:
+            finish_group(*in_flight)
+
+        for upload in uploads:
+            upload.result()
+
+def run(offset, length, min_length, workers, overwrite=False, precision=None, parallel_factor=None):
+    device = settings.TORCH_DEVICE_MODEL
+    if device == "cuda":
+        workers = min(workers, MAX_GPU_WORKERS)
+    if parallel_factor is None:
+        parallel_factor = get_parallel_factor(workers, device)
+
+    tmp_dir = get_scratch_dir()
+    logger.info(f"run(offset={offset}, length={length}, min_length={min_length}, workers={workers}, overwrite={overwrite}, precision={precision}, parallel_factor={parallel_factor})")
+    logger.info(f'Using temp dir: {tmp_dir}')
+    
+    logger.info(f'Get file list from Azure storage...')
+
+    with timer("get_index"):
+        index_file = get_index_file(g_config.index_url)
+        with open(index_file) as fin:
+            urls = [url.strip() for url in islice(fin, offset, offset + length)]
+    
+    logger.info(f'Processing {len(urls)} files')
+
+    pdf_dir = os.path.join(tmp_dir, "pdfs")
+    os.makedirs(pdf_dir, exist_ok=True)
+    
+    # conversion runs in the worker processes, transfers stay in this one
+    # spawned rather than forked, the cuda probe above would leave forked workers unable to use the gpu
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(workers, precision)
+        ) as executor:
+        process_minibatch(urls, pdf_dir, executor, min_length=min_length, overwrite=overwrite, parallel_factor=parallel_factor)
     
     logger.info(f'All files processed')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Convert multiple pdfs to markdown.")
-    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes to use")
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 4), help="Number of worker processes to use")
     parser.add_argument("--min_length", type=int, default=2000, help="Minimum length of pdf to convert")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")  # Add this line
+    parser.add_argument("--overwrite", action="store_true", help="Convert files again even if their output already exists")
+    parser.add_argument("--parallel_factor", type=int, default=None, help="How much to multiply model batch sizes by, defaults to each worker's share of VRAM")
+    parser.add_argument("--effective_concurrency", type=int, default=None, help="Tasks the pool runs at once (pods * tasks per pod), splits the index into that many tasks instead of batch_size files each")
+    parser.add_argument("--precision", choices=list(PRECISION_DTYPES), default=None, help="Model precision, defaults to bf16 on GPUs that support it")
 
     args = parser.parse_args()
 
+    for key, value in AZCOPY_ENV.items():
+        os.environ.setdefault(key, value)
+
     if batch_utils.in_batch_cluster():
         g_config = get_config_fromenv()
     else:
@@ -242,38 +630,49 @@ if __name__ == '__main__':
             "marker/inst.sh",
             gen_obsidian_init_command(g_config.branch),
             'python3 marker/convert_batch.py' # use your own script name
+            + (' --overwrite' if args.overwrite else '')
+            + (f' --precision {args.precision}' if args.precision else '')
+            + (f' --parallel_factor {args.parallel_factor}' if args.parallel_factor else '')
         ]
 
-    sas_token = get_blob_sas(g_config.identity_id, g_config.keyvault_name, g_config.secret_name)
-    g_config.src_url = g_config.src_url.format(sas_token=sas_token.value)
-    g_config.dst_url = g_config.dst_url.format(sas_token=sas_token.value)
-    g_config.index_url = g_config.index_url.format(sas_token=sas_token.value)
+    # Tasks get the urls with the token already filled in by the submitter, only templates need Key Vault
+    if any("{sas_token}" in url for url in (g_config.src_url, g_config.dst_url, g_config.index_url)):
+        # A submitted token has to last for the whole job, not just the cache's minimum, so take a fresh one
+        submitting = not batch_utils.in_batch_cluster() and not args.debug
+        sas_token = get_blob_sas(g_config.identity_id, g_config.keyvault_name, g_config.secret_name, use_cache=not submitting)
+        g_config.src_url = g_config.src_url.format(sas_token=sas_token)
+        g_config.dst_url = g_config.dst_url.format(sas_token=sas_token)
+        g_config.index_url = g_config.index_url.format(sas_token=sas_token)
 
 
     if batch_utils.in_batch_cluster():
         # run in cluster
-        run(g_config.offset, g_config.length, args.min_length, args.workers)
+        run(g_config.offset, g_config.length, args.min_length, args.workers, args.overwrite, args.precision, args.parallel_factor)
     else:
         # run locally
  
         if args.debug:
             # local debug
             logger.info('Running in debug mode')
-            run(g_config.offset, g_config.length, args.min_length, args.workers)
+            run(g_config.offset, g_config.length, args.min_length, args.workers, args.overwrite, args.precision, args.parallel_factor)
         else:
             # submit to cluster
             tot_files = get_file_count(g_config.index_url)
+            # One task per slot of the pool, so every slot gets a single steady run, otherwise
+            # fixed-size tasks that the pool works through as slots free up
+            batch_size = max(1, math.ceil(tot_files / args.effective_concurrency)) if args.effective_concurrency else g_config.batch_size
+            logger.info(f'Submitting {math.ceil(tot_files / batch_size)} tasks of {batch_size} files')
             tasks = []
             current_date = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
             job_id = f'{g_config.job_id_prefix}{current_date}'
-            for offset in range(0, tot_files, g_config.batch_size):
+            for offset in range(0, tot_files, batch_size):
                 task = batch_utils.create_task(
                     job_id,
-                    f'task-{offset}-{offset + g_config.batch_size - 1}',
+                    f'task-{offset}-{min(offset + batch_size, tot_files) - 1}',
                     ' && '.join(commands),
                     environs={
                         ENV_OFFSET: offset,
-                        ENV_LENGTH: g_config.batch_size,
+                        ENV_LENGTH: batch_size,
                         ENV_INDEX_URL: g_config.index_url,
                         ENV_SRC_URL: g_config.src_url,
                         ENV_DST_URL: g_config.dst_url,
@@ -284,9 +683,6 @@ if __name__ == '__main__':
                 )
                 tasks.append(task)
 
-                # only submit one batch for debug
-                #break
-
             batch_utils.submit_tasks(
                 g_config.batch_url,
                 g_config.pool_id,
@@ -42,17 +42,21 @@ def annotate_spans(blocks: List[Page], block_types: List[BlockType]):
         page.add_block_types(page_block_types)
 
 
+def get_length_of_pages(pages) -> int:
+    full_text = ""
+    for page in pages:
+        full_text += page.get_text("text", sort=True, flags=settings.TEXT_FLAGS)
+
+    return len(full_text)
+
+
 def get_length_of_text(fname: str) -> int:
     filetype = find_filetype(fname)
     if filetype == "other":
         return 0
 
     doc = pymupdf.open(fname, filetype=filetype)
-    full_text = ""
-    for page in doc:
-        full_text += page.get_text("text", sort=True, flags=settings.TEXT_FLAGS)
-
-    return len(full_text)
+    return get_length_of_pages(doc)
 
 
 def convert_single_pdf(
@@ -60,7 +64,8 @@ def convert_single_pdf(
         model_lst: List,
         max_pages=None,
         metadata: Optional[Dict]=None,
-        parallel_factor: int = 1
+        parallel_factor: int = 1,
+        ocr_parallel: Optional[int] = None
 ) -> Tuple[str, Dict]:
     lang = settings.DEFAULT_LANG
     if metadata:
@@ -91,7 +96,7 @@ def convert_single_pdf(
         tess_lang,
         spell_lang,
         max_pages=max_pages,
-        parallel=int(parallel_factor * settings.OCR_PARALLEL_WORKERS)
+        parallel=ocr_parallel if ocr_parallel is not None else int(parallel_factor * settings.OCR_PARALLEL_WORKERS)
     )
 
     out_meta["toc"] = toc
@@ -1,5 +1,5 @@
 import os
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Literal
 
 from dotenv import find_dotenv
 from pydantic import computed_field
@@ -7,6 +7,12 @@ from pydantic_settings import BaseSettings
 import fitz as pymupdf
 import torch
 
+PRECISION_DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
 
 class Settings(BaseSettings):
     # General
@@ -26,6 +32,7 @@ class Settings(BaseSettings):
 
         return "cpu"
 
+    MODEL_PRECISION: Optional[Literal["fp32", "fp16", "bf16"]] = None # Defaults to bf16 on GPUs that support it, fp16 on older ones, and fp32 on cpu.
     INFERENCE_RAM: int = 40 # How much VRAM each GPU has (in GB).
     VRAM_PER_TASK: float = 2.5 # How much VRAM to allocate per task (in GB).  Peak marker VRAM usage is around 3GB, but avg across workers is lower.
     DEFAULT_LANG: str = "English" # Default language we assume files to be in, should be one of the keys in TESSERACT_LANGUAGES
@@ -117,14 +124,20 @@ class Settings(BaseSettings):
     @computed_field
     @property
     def MODEL_DTYPE(self) -> torch.dtype:
+        if self.MODEL_PRECISION is not None:
+            return PRECISION_DTYPES[self.MODEL_PRECISION]
+
         if self.TORCH_DEVICE_MODEL == "cuda":
-            return torch.bfloat16
+            return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
         else:
             return torch.float32
 
     @computed_field
     @property
     def TEXIFY_DTYPE(self) -> torch.dtype:
+        if self.MODEL_PRECISION is not None:
+            return PRECISION_DTYPES[self.MODEL_PRECISION]
+
         return torch.float32 if self.TORCH_DEVICE_MODEL == "cpu" else torch.float16
 
     class Config: